@@ -15,11 +15,12 @@ lcd = CharLCD(
 
 lcd.clear()
 
-# Write on all 4 lines
-lcd.write_string('Line 1: Hello World!')
-#lcd.cursor_pos = (1, 0)
-lcd.write_string('Line 2: LCD Ready')
-#lcd.cursor_pos = (2, 0)
-lcd.write_string('Line 3: Raspberry Pi')
-#lcd.cursor_pos = (3, 0)
-lcd.write_string('Line 4: I2C OK')
+# Write on all 4 lines: pad each line to the 20 columns and send one frame,
+# auto_linebreaks moves the cursor to the next row after each 20 characters
+frame = (
+    'Line 1: Hello World!'.ljust(20)
+    + 'Line 2: LCD Ready'.ljust(20)
+    + 'Line 3: Raspberry Pi'.ljust(20)
+    + 'Line 4: I2C OK'.ljust(20)
+)
+lcd.write_string(frame)
@@ -8,12 +8,14 @@ Author: Ruman Ahmed
 
 import paho.mqtt.client as mqtt
 from paho.mqtt.enums import CallbackAPIVersion
+from paho.mqtt.subscribeoptions import SubscribeOptions
 import time
 import uuid
-import json
+import orjson
 import logging
 import ssl
 import random
+from types import SimpleNamespace
 
 # -------------------------------------------------------------------
 # Setup logger
@@ -32,13 +34,36 @@ PORT = 8883  # TLS port
 
 DEVICE_ID = uuid.getnode()
 DEVICE_ID_STR = f"atm-{DEVICE_ID:012x}"
-TOPIC_PUB_UID = f"water_atm/{DEVICE_ID_STR}/uid"
+TOPIC_PUB_UID_RAW = f"water_atm/{DEVICE_ID_STR}/uid_raw"  # Raw 4-byte big-endian UID
 TOPIC_PUB_RESULT = f"water_atm/{DEVICE_ID_STR}/result"
 TOPIC_SUB_AUTH = f"water_atm/{DEVICE_ID_STR}/auth"
 TOPIC_SUB_CONFIRM = f"water_atm/{DEVICE_ID_STR}/confirm"
 
-authenticated = False
-balance = 0
+# MQTT 5: the broker skips retained messages at subscribe time and our own publishes
+SUB_OPTIONS = SubscribeOptions(qos=0, noLocal=True,
+                               retainHandling=SubscribeOptions.RETAIN_DO_NOT_SEND)
+
+UID_INTERVAL = 10  # Seconds between simulated card reads
+
+# Reconnect backoff: up to RECONNECT_ATTEMPTS tries, waiting 1 s, 2 s, 4 s, ...
+# (capped at RECONNECT_MAX_DELAY) between them, then give up
+RECONNECT_ATTEMPTS = 8
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+# -------------------------------------------------------------------
+# TLS: resume the previous session when reconnecting
+# -------------------------------------------------------------------
+class ResumableTLSContext(ssl.SSLContext):
+    session = None  # Session of the last connection, offered on the next handshake
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        kwargs.setdefault("session", self.session)
+        return super().wrap_socket(sock, *args, **kwargs)
+
+# Uses system CA certificates, like tls_set(tls_version=ssl.PROTOCOL_TLS_CLIENT)
+TLS_CONTEXT = ResumableTLSContext(ssl.PROTOCOL_TLS_CLIENT)
+TLS_CONTEXT.load_default_certs()
 
 # -------------------------------------------------------------------
 # Callback: When client connects to broker
@@ -46,9 +71,15 @@ balance = 0
 def on_connect(client, userdata, flags, reason_code, properties=None):
     if reason_code == 0:
         logger.info("Connected to MQTT Broker")
+
+        # Keep the TLS session so a reconnect can skip the full handshake
+        sock = client.socket()
+        if isinstance(sock, ssl.SSLSocket):
+            TLS_CONTEXT.session = sock.session
+
         try:
-            client.subscribe(TOPIC_SUB_AUTH, qos=0)
-            client.subscribe(TOPIC_SUB_CONFIRM, qos=0)
+            # One SUBSCRIBE packet for both topics
+            client.subscribe([(TOPIC_SUB_AUTH, SUB_OPTIONS), (TOPIC_SUB_CONFIRM, SUB_OPTIONS)])
             logger.info(f"Subscribed to topics: {TOPIC_SUB_AUTH}, {TOPIC_SUB_CONFIRM}")
         except Exception as e:
             logger.error(f"Subscription failed: {e}")
@@ -56,37 +87,44 @@ def on_connect(client, userdata, flags, reason_code, properties=None):
         logger.error(f"Failed to connect, reason code {reason_code}")
 
 # -------------------------------------------------------------------
-# Callback: When message is received
+# Message handlers, one per subscribed topic
 # -------------------------------------------------------------------
-def on_message(client, userdata, msg):
-    global authenticated, balance
-    try:
-        if msg.retain:
-            logger.warning("Retained message received. Ignoring.")
-            return
+def handle_auth(client, userdata, data):
+    user_exists = data.get("exists", False)
+    userdata.balance = data.get("balance", 0)
 
-        payload = msg.payload.decode()
-        logger.info(f"Received message on {msg.topic}: {payload}")
-        data = json.loads(payload)
+    if user_exists:
+        logger.info(f"User authenticated. Balance: {userdata.balance} L")
+        dispense_water(client, userdata)
+    else:
+        logger.warning("Authentication failed. User does not exist.")
 
-        if msg.topic == TOPIC_SUB_AUTH:
-            user_exists = data.get("exists", False)
-            balance = data.get("balance", 0)
+def handle_confirm(client, userdata, data):
+    server_confirm = data.get("updated", False)
+    if server_confirm:
+        logger.info("Server confirmed balance update.")
+    else:
+        logger.warning("Server failed to confirm balance update.")
 
-            if user_exists:
-                authenticated = True
-                logger.info(f"User authenticated. Balance: {balance} L")
-                dispense_water(client)
-                authenticated = False
-            else:
-                logger.warning("Authentication failed. User does not exist.")
+TOPIC_HANDLERS = {
+    TOPIC_SUB_AUTH: handle_auth,
+    TOPIC_SUB_CONFIRM: handle_confirm,
+}
 
-        elif msg.topic == TOPIC_SUB_CONFIRM:
-            server_confirm = data.get("updated", False)
-            if server_confirm:
-                logger.info("Server confirmed balance update.")
-            else:
-                logger.warning("Server failed to confirm balance update.")
+# -------------------------------------------------------------------
+# Callback: When message is received
+# -------------------------------------------------------------------
+def on_message(client, userdata, msg):
+    # Retained messages never arrive here: the broker filters them via SUB_OPTIONS
+    try:
+        # Lazy %-formatting: nothing is decoded or formatted if INFO is filtered out
+        logger.info("Received message on %s: %s", msg.topic, msg.payload)
+
+        handler = TOPIC_HANDLERS.get(msg.topic)
+        if handler is None:
+            return
+        data = orjson.loads(msg.payload)  # Parses the raw bytes directly
+        handler(client, userdata, data)
 
     except Exception as e:
         logger.error(f"Error while processing incoming message: {e}")
@@ -99,99 +137,125 @@ def on_disconnect(client, userdata, disconnect_flags, reason_code, properties=No
         logger.info("Disconnected cleanly from MQTT broker")
         return
 
-    logger.warning("Disconnected unexpectedly from MQTT broker")
-    while True:
+    # main() reconnects once client.loop() returns; blocking here would stall paho
+    logger.warning(f"Disconnected unexpectedly from MQTT broker, reason code {reason_code}")
+
+# -------------------------------------------------------------------
+# Reconnect with exponential backoff, called from main()
+# -------------------------------------------------------------------
+def reconnect_with_backoff(client):
+    delay = RECONNECT_MIN_DELAY
+    for attempt in range(1, RECONNECT_ATTEMPTS + 1):
         try:
-            logger.info("Attempting to reconnect...")
+            logger.info(f"Attempting to reconnect ({attempt}/{RECONNECT_ATTEMPTS})...")
             client.reconnect()
             logger.info("Reconnected successfully")
-            break
+            return True
         except Exception as e:
-            logger.error(f"Reconnect failed: {e}")
-            time.sleep(5)
+            if attempt == RECONNECT_ATTEMPTS:
+                logger.error(f"Reconnect failed: {e}")
+                break
+            logger.error(f"Reconnect failed: {e}. Retrying in {delay} s")
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+    logger.error("Giving up on reconnecting to MQTT broker")
+    return False
 
 # -------------------------------------------------------------------
 # Simulate NFC UID read
 # -------------------------------------------------------------------
 def simulate_nfc_uid():
-    return uuid.uuid4().hex[:8]  # Simulated UID
+    return random.getrandbits(32)  # Simulated 32-bit UID
 
 # -------------------------------------------------------------------
 # Simulate water dispensing and flow sensor
 # -------------------------------------------------------------------
-def dispense_water(client):
-    global balance
+def dispense_water(client, state):
     logger.info("Starting water dispensing...")
 
     total_pulses = 0
     duration = 5
-    start_time = time.time()
+    sample_interval = 0.2
+    # Draw every flow sensor reading for the run in a single call
+    readings = random.choices(range(1, 6), k=int(duration / sample_interval))
+    deadline = time.monotonic() + duration  # Immune to wall-clock (NTP) jumps
 
-    while time.time() - start_time < duration:
-        pulses = random.randint(1, 5)
+    for pulses in readings:
+        if time.monotonic() >= deadline:
+            break
         total_pulses += pulses
-        time.sleep(0.2)
+        time.sleep(sample_interval)
 
     water_dispensed_ml = total_pulses * 2
     water_dispensed_liters = round(water_dispensed_ml / 1000, 2)
 
     logger.info(f"Water dispensed: {water_dispensed_liters} L")
-    balance -= water_dispensed_liters
-    balance = max(balance, 0)
-
-    message = json.dumps({
-        "dispensed": water_dispensed_liters,
-        "updated_balance": round(balance, 2)
-    })
-
-    if client.is_connected():
-        result = client.publish(TOPIC_PUB_RESULT, message, qos=0, retain=False)
-        if result.rc == mqtt.MQTT_ERR_SUCCESS:
-            logger.info(f"Sent result to server: {message}")
-        else:
-            logger.warning("Publish failed")
+    state.balance = max(state.balance - water_dispensed_liters, 0)
+
+    # Fixed schema of numbers only, so plain formatting matches json.dumps
+    message = f'{{"dispensed":{water_dispensed_liters},"updated_balance":{round(state.balance, 2)}}}'
+
+    result = client.publish(TOPIC_PUB_RESULT, message, qos=0, retain=False)
+    if result.rc == mqtt.MQTT_ERR_SUCCESS:
+        logger.info(f"Sent result to server: {message}")
+    elif result.rc == mqtt.MQTT_ERR_NO_CONN:
+        logger.error("MQTT disconnected — result not sent")
     else:
-        logger.error("MQTT disconnected — skipping publish")
+        logger.warning("Publish failed")
 
 # -------------------------------------------------------------------
 # Main Function
 # -------------------------------------------------------------------
 def main():
-    client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, clean_session=True)
+    # Session state handed to every callback as userdata
+    state = SimpleNamespace(balance=0)
+
+    client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2,
+                         protocol=mqtt.MQTTv5, userdata=state)
     client.max_queued_messages_set(0)
     client.on_connect = on_connect
     client.on_message = on_message
     client.on_disconnect = on_disconnect
 
-    client.tls_set(tls_version=ssl.PROTOCOL_TLS_CLIENT)
+    client.tls_set_context(TLS_CONTEXT)
 
     try:
-        client.connect(BROKER, PORT, keepalive=60)
+        client.connect(BROKER, PORT, keepalive=60, clean_start=True)
     except Exception as e:
         logger.error(f"Could not connect to broker: {e}")
         return
 
-    client.loop_start()
+    next_read = time.monotonic()
 
     try:
+        # Network I/O and card reads share this thread: client.loop() waits on
+        # the socket until the next read is due instead of sleeping blindly.
         while True:
-            if not authenticated:
-                uid = simulate_nfc_uid()
-                message = json.dumps({"uid": uid})
-                logger.info(f"Publishing UID: {uid} to topic: {TOPIC_PUB_UID}")
-                if client.is_connected():
-                    result = client.publish(TOPIC_PUB_UID, message, qos=0, retain=False)
-                    if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                        logger.info("UID published successfully")
-                    else:
-                        logger.warning(f"Failed to publish UID. Status: {result.rc}")
-                else:
-                    logger.error("MQTT disconnected — skipping publish")
-            time.sleep(10)
+            rc = client.loop(timeout=max(next_read - time.monotonic(), 0))
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                if not reconnect_with_backoff(client):
+                    logger.error("No connection to MQTT broker. Stopping.")
+                    break
+                continue
+            if time.monotonic() < next_read:
+                continue
+            next_read = time.monotonic() + UID_INTERVAL
+
+            # No card reads during a dispense: dispense_water() runs inside
+            # client.loop() on this same thread, so the two never overlap.
+            uid = simulate_nfc_uid()
+            message = uid.to_bytes(4, "big")
+            logger.info(f"Publishing UID: {uid:08x} to topic: {TOPIC_PUB_UID_RAW}")
+            result = client.publish(TOPIC_PUB_UID_RAW, message, qos=0, retain=False)
+            if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                logger.info("UID published successfully")
+            elif result.rc == mqtt.MQTT_ERR_NO_CONN:
+                logger.error("MQTT disconnected — UID not sent")
+            else:
+                logger.warning(f"Failed to publish UID. Status: {result.rc}")
     except KeyboardInterrupt:
         logger.info("Disconnecting...")
     finally:
-        client.loop_stop()
         client.disconnect()
 
 # -------------------------------------------------------------------
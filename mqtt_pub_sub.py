@@ -7,12 +7,15 @@ Author: Ruman Ahmed
 """
 
 import paho.mqtt.client as mqtt
+import paho.mqtt.publish as publish
 from paho.mqtt.enums import CallbackAPIVersion
 import time
 import uuid
-import json
+import orjson
 import logging
 import ssl
+import random
+import sys
 
 # -------------------------------------------------------------------
 # Setup logger
@@ -35,15 +38,48 @@ PORT = 8883
 # Example topics (should be customized per device or environment)
 DEVICE_ID = uuid.getnode()
 DEVICE_ID_STR = f"atm-{DEVICE_ID:012x}"
-TOPIC_PUB = f"water_atm/{DEVICE_ID_STR}/uid"
+TOPIC_PUB_UID_RAW = f"water_atm/{DEVICE_ID_STR}/uid_raw"  # Raw 4-byte big-endian UIDs
 TOPIC_SUB = f"water_atm/{DEVICE_ID_STR}/auth"
 
+# UID batching: publish once BATCH_MAX UIDs are buffered or BATCH_MAX_MS has elapsed
+BATCH_MAX = 32
+BATCH_MAX_MS = 500
+# Seconds between simulated card reads. At 1 s every batch holds a single UID;
+# lower it (e.g. 0.1) to see batches fill, at 10x the traffic to the broker.
+CARD_INTERVAL = 1
+
+# Reconnect backoff: up to RECONNECT_ATTEMPTS tries, waiting 1 s, 2 s, 4 s, ...
+# (capped at RECONNECT_MAX_DELAY) between them, then give up
+RECONNECT_ATTEMPTS = 8
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+# -------------------------------------------------------------------
+# TLS: resume the previous session when reconnecting
+# -------------------------------------------------------------------
+class ResumableTLSContext(ssl.SSLContext):
+    session = None  # Session of the last connection, offered on the next handshake
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        kwargs.setdefault("session", self.session)
+        return super().wrap_socket(sock, *args, **kwargs)
+
+# Uses system CA certificates, like tls_set(tls_version=ssl.PROTOCOL_TLS_CLIENT)
+TLS_CONTEXT = ResumableTLSContext(ssl.PROTOCOL_TLS_CLIENT)
+TLS_CONTEXT.load_default_certs()
+
 # -------------------------------------------------------------------
 # Callback: When client connects to broker
 # -------------------------------------------------------------------
 def on_connect(client, userdata, flags, reason_code, properties=None):
     if reason_code == 0:
         logger.info("Connected to MQTT Broker")
+
+        # Keep the TLS session so a reconnect can skip the full handshake
+        sock = client.socket()
+        if isinstance(sock, ssl.SSLSocket):
+            TLS_CONTEXT.session = sock.session
+
         try:
             client.subscribe(TOPIC_SUB)
             logger.info(f"Subscribed to topic: {TOPIC_SUB}")
@@ -57,11 +93,11 @@ def on_connect(client, userdata, flags, reason_code, properties=None):
 # -------------------------------------------------------------------
 def on_message(client, userdata, msg):
     try:
-        payload = msg.payload.decode()
-        logger.info(f"Received message on {msg.topic}: {payload}")
+        # Lazy %-formatting: nothing is decoded or formatted if INFO is filtered out
+        logger.info("Received message on %s: %s", msg.topic, msg.payload)
 
         # Process the response
-        data = json.loads(payload)
+        data = orjson.loads(msg.payload)  # Parses the raw bytes directly
         user_exists = data.get("exists", False)
         balance = data.get("balance", 0)
 
@@ -73,14 +109,81 @@ def on_message(client, userdata, msg):
     except Exception as e:
         logger.error(f"Error while processing incoming message: {e}")
 
+# -------------------------------------------------------------------
+# Callback: When client disconnects from broker
+# -------------------------------------------------------------------
+def on_disconnect(client, userdata, disconnect_flags, reason_code, properties=None):
+    if reason_code == mqtt.MQTT_ERR_SUCCESS:
+        logger.info("Disconnected cleanly from MQTT broker")
+        return
+
+    # main() reconnects once client.loop() returns; blocking here would stall paho
+    logger.warning(f"Disconnected unexpectedly from MQTT broker, reason code {reason_code}")
+
+# -------------------------------------------------------------------
+# Reconnect with exponential backoff, called from main()
+# -------------------------------------------------------------------
+def reconnect_with_backoff(client):
+    delay = RECONNECT_MIN_DELAY
+    for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+        try:
+            logger.info(f"Attempting to reconnect ({attempt}/{RECONNECT_ATTEMPTS})...")
+            client.reconnect()
+            logger.info("Reconnected successfully")
+            return True
+        except Exception as e:
+            if attempt == RECONNECT_ATTEMPTS:
+                logger.error(f"Reconnect failed: {e}")
+                break
+            logger.error(f"Reconnect failed: {e}. Retrying in {delay} s")
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+    logger.error("Giving up on reconnecting to MQTT broker")
+    return False
+
 # -------------------------------------------------------------------
 # Simulate NFC UID read and publish it
 # -------------------------------------------------------------------
 def simulate_nfc_uid():
     # In real-world scenario, this will come from your NFC reader hardware
-    fake_uid = uuid.uuid4().hex[:8]  # Simulate a UID like "9f8d7a5c"
+    fake_uid = random.getrandbits(32)  # Simulate a 32-bit UID like 0x9f8d7a5c
     return fake_uid
 
+# -------------------------------------------------------------------
+# Publish the buffered UIDs as one message and empty the buffer
+# -------------------------------------------------------------------
+def flush_uid_batch(client, buf):
+    # Concatenated 4-byte UIDs; the server splits every 4 bytes
+    message = b"".join(uid.to_bytes(4, "big") for uid in buf)
+    logger.info(f"Publishing {len(buf)} UIDs to topic: {TOPIC_PUB_UID_RAW}")
+
+    try:
+        result = client.publish(TOPIC_PUB_UID_RAW, message)
+        status = result.rc
+        if status == mqtt.MQTT_ERR_SUCCESS:
+            logger.info("UID batch published successfully")
+        else:
+            logger.warning(f"Failed to publish UID batch. Status: {status}")
+    except Exception as e:
+        logger.error(f"Error during publish: {e}")
+
+    buf.clear()
+
+# -------------------------------------------------------------------
+# One-shot burst: connect, publish a batch of UIDs, disconnect
+# -------------------------------------------------------------------
+def publish_uid_burst(count=BATCH_MAX):
+    # For a pure publisher: no subscriptions, no loop thread, one TLS connection
+    msgs = [{"topic": TOPIC_PUB_UID_RAW, "payload": simulate_nfc_uid().to_bytes(4, "big")}
+            for _ in range(count)]
+    logger.info(f"Publishing burst of {count} UIDs to topic: {TOPIC_PUB_UID_RAW}")
+
+    try:
+        publish.multiple(msgs, hostname=BROKER, port=PORT, tls=TLS_CONTEXT)
+        logger.info("UID burst published successfully")
+    except Exception as e:
+        logger.error(f"Error during burst publish: {e}")
+
 # -------------------------------------------------------------------
 # Main Function
 # -------------------------------------------------------------------
@@ -88,9 +191,10 @@ def main():
     client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2)
     client.on_connect = on_connect
     client.on_message = on_message
+    client.on_disconnect = on_disconnect
 
-    # Enable TLS using system CA certificates
-    client.tls_set(tls_version=ssl.PROTOCOL_TLS_CLIENT)
+    # Enable TLS using system CA certificates, with session resumption
+    client.tls_set_context(TLS_CONTEXT)
 
     try:
         client.connect(BROKER, PORT, keepalive=60)
@@ -98,34 +202,46 @@ def main():
         logger.error(f"Could not connect to broker: {e}")
         return
 
-    client.loop_start()
+    buf = []
+    batch_deadline = None  # When the oldest buffered UID has waited BATCH_MAX_MS
+    next_read = time.monotonic()
 
     try:
+        # Network I/O, card reads and batch flushes share this thread: client.loop()
+        # waits on the socket until the next read or flush is due.
         while True:
-            uid = simulate_nfc_uid()
-            message = json.dumps({"uid": uid})
-            logger.info(f"Publishing UID: {uid} to topic: {TOPIC_PUB}")
-
-            try:
-                result = client.publish(TOPIC_PUB, message)
-                status = result.rc
-                if status == mqtt.MQTT_ERR_SUCCESS:
-                    logger.info("UID published successfully")
-                else:
-                    logger.warning(f"Failed to publish UID. Status: {status}")
-            except Exception as e:
-                logger.error(f"Error during publish: {e}")
-
-            time.sleep(1)  # Simulate waiting for the next card
+            wake_at = min(next_read, batch_deadline) if buf else next_read
+            rc = client.loop(timeout=max(wake_at - time.monotonic(), 0))
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                if not reconnect_with_backoff(client):
+                    logger.error("No connection to MQTT broker. Stopping.")
+                    break
+                continue
+
+            now = time.monotonic()
+            if now >= next_read:
+                # Simulate waiting for the next card; never replay reads missed during a stall
+                next_read = max(next_read + CARD_INTERVAL, now)
+                if not buf:
+                    batch_deadline = now + BATCH_MAX_MS / 1000
+                buf.append(simulate_nfc_uid())
+
+            if buf and (len(buf) >= BATCH_MAX or now >= batch_deadline):
+                flush_uid_batch(client, buf)
 
     except KeyboardInterrupt:
         logger.info("Disconnecting...")
     finally:
-        client.loop_stop()
+        if buf:
+            flush_uid_batch(client, buf)  # Don't drop UIDs read since the last flush
         client.disconnect()
 
 # -------------------------------------------------------------------
 # Entry point
 # -------------------------------------------------------------------
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # python mqtt_pub_sub.py --burst  publishes one batch of UIDs and exits
+    if len(sys.argv) > 1 and sys.argv[1] == "--burst":
+        publish_uid_burst()
+    else:
+        main()
\ No newline at end of file
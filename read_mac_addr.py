@@ -5,6 +5,7 @@
 
 import os
 import logging
+from functools import lru_cache
 
 # ------------------------------------------------------------------------------
 # Setup logger
@@ -24,15 +25,31 @@ logging.basicConfig(
 # MAC Address Utilities
 # ------------------------------------------------------------------------------
 
+## @brief MAC addresses already read, keyed by interface name (successful reads only)
+_mac_cache = {}
+
 ## @brief Reads the MAC address from a given network interface.
 #  @param interface Name of the network interface (e.g., "eth0", "wlan0")
 #  @return MAC address string in standard format (e.g., "dc:a6:32:1e:12:34") or None if not found
+#  @note Cached per interface once read; the MAC does not change while the device is running,
+#        but an interface that is not up yet is looked up again on the next call
 def get_mac(interface='eth0'):
+    mac = _mac_cache.get(interface)
+    if mac:
+        return mac
+
     try:
-        with open(f'/sys/class/net/{interface}/address') as f:
-            mac = f.read().strip()
-            logger.debug(f"MAC address from {interface}: {mac}")
-            return mac
+        # Raw fd read, no io buffering needed. Read up to a page: Ethernet
+        # addresses are 17 chars, but e.g. InfiniBand ones are 59.
+        fd = os.open(f'/sys/class/net/{interface}/address', os.O_RDONLY)
+        try:
+            mac = os.read(fd, 4096).decode().strip()
+        finally:
+            os.close(fd)
+        logger.debug(f"MAC address from {interface}: {mac}")
+        if mac:
+            _mac_cache[interface] = mac
+        return mac
     except FileNotFoundError:
         logger.error(f"Interface {interface} not found.")
         return None
@@ -40,6 +57,7 @@ def get_mac(interface='eth0'):
 ## @brief Formats a MAC address into a lowercase, MQTT-safe string (removes colons).
 #  @param mac The MAC address in standard format
 #  @return Formatted MAC string (e.g., "dca6321e1234")
+@lru_cache(maxsize=4)
 def format_mac_for_id(mac):
     formatted = mac.replace(":", "").lower() if mac else "unknown"
     logger.debug(f"Formatted MAC for ID: {formatted}")
@@ -8,13 +8,17 @@ Author: Ruman Ahmed
 
 import paho.mqtt.client as mqtt
 from paho.mqtt.enums import CallbackAPIVersion
+from paho.mqtt.subscribeoptions import SubscribeOptions
 import time
 import uuid
-import json
+import orjson
 import logging
 import ssl
 import random
-from mfrc522 import SimpleMFRC522
+import threading
+from types import SimpleNamespace
+import RPi.GPIO as GPIO
+from mfrc522 import MFRC522
 
 # -------------------------------------------------------------------
 # Setup logger
@@ -37,10 +41,37 @@ TOPIC_PUB_RESULT = f"water_atm/{DEVICE_ID_STR}/result"
 TOPIC_SUB_AUTH = f"water_atm/{DEVICE_ID_STR}/auth"
 TOPIC_SUB_CONFIRM = f"water_atm/{DEVICE_ID_STR}/confirm"
 
-authenticated = False
-balance = 0
-current_card_uid = None
-reader = SimpleMFRC522()
+# MQTT 5: the broker skips retained messages at subscribe time and our own publishes
+SUB_OPTIONS = SubscribeOptions(qos=0, noLocal=True,
+                               retainHandling=SubscribeOptions.RETAIN_DO_NOT_SEND)
+
+# Reconnect backoff: 1 s, 2 s, 4 s, ... capped at RECONNECT_MAX_DELAY
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+# -------------------------------------------------------------------
+# RFID Settings
+# -------------------------------------------------------------------
+IRQ_PIN = 18          # MFRC522 IRQ line (physical pin 18 / GPIO24)
+REARM_INTERVAL = 0.2  # Seconds between card-detect requests sent by the reader
+CARD_TIMEOUT = 1.0    # Seconds without a card IRQ before the card counts as removed
+
+reader = MFRC522()
+reader_lock = threading.Lock()  # IRQ callback and main thread share the SPI bus
+
+# -------------------------------------------------------------------
+# TLS: resume the previous session when reconnecting
+# -------------------------------------------------------------------
+class ResumableTLSContext(ssl.SSLContext):
+    session = None  # Session of the last connection, offered on the next handshake
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        kwargs.setdefault("session", self.session)
+        return super().wrap_socket(sock, *args, **kwargs)
+
+# Uses system CA certificates, like tls_set(tls_version=ssl.PROTOCOL_TLS_CLIENT)
+TLS_CONTEXT = ResumableTLSContext(ssl.PROTOCOL_TLS_CLIENT)
+TLS_CONTEXT.load_default_certs()
 
 # -------------------------------------------------------------------
 # Callback: When client connects to broker
@@ -48,47 +79,62 @@ reader = SimpleMFRC522()
 def on_connect(client, userdata, flags, reason_code, properties=None):
     if reason_code == 0:
         logger.info("Connected to MQTT Broker")
+
+        # Keep the TLS session so a reconnect can skip the full handshake
+        sock = client.socket()
+        if isinstance(sock, ssl.SSLSocket):
+            TLS_CONTEXT.session = sock.session
+
         try:
-            client.subscribe(TOPIC_SUB_AUTH, qos=0)
-            client.subscribe(TOPIC_SUB_CONFIRM, qos=0)
+            # One SUBSCRIBE packet for both topics
+            client.subscribe([(TOPIC_SUB_AUTH, SUB_OPTIONS), (TOPIC_SUB_CONFIRM, SUB_OPTIONS)])
             logger.info(f"Subscribed to topics: {TOPIC_SUB_AUTH}, {TOPIC_SUB_CONFIRM}")
         except Exception as e:
             logger.error(f"Subscription failed: {e}")
     else:
         logger.error(f"Failed to connect, reason code {reason_code}")
 
+# -------------------------------------------------------------------
+# Message handlers, one per subscribed topic
+# -------------------------------------------------------------------
+def handle_auth(client, userdata, data):
+    user_exists = data.get("exists", False)
+    userdata.balance = data.get("balance", 0)
+
+    if user_exists:
+        userdata.authenticated = True
+        logger.info(f"User authenticated. Balance: {userdata.balance} L")
+        start_dispensing(client, userdata)
+        userdata.authenticated = False
+    else:
+        logger.warning("Authentication failed. User does not exist.")
+
+def handle_confirm(client, userdata, data):
+    server_confirm = data.get("updated", False)
+    if server_confirm:
+        logger.info("Server confirmed balance update.")
+    else:
+        logger.warning("Server failed to confirm balance update.")
+
+TOPIC_HANDLERS = {
+    TOPIC_SUB_AUTH: handle_auth,
+    TOPIC_SUB_CONFIRM: handle_confirm,
+}
+
 # -------------------------------------------------------------------
 # Callback: When message is received
 # -------------------------------------------------------------------
 def on_message(client, userdata, msg):
-    global authenticated, balance
+    # Retained messages never arrive here: the broker filters them via SUB_OPTIONS
     try:
-        if msg.retain:
-            logger.warning("Retained message received. Ignoring.")
-            return
+        # Lazy %-formatting: nothing is decoded or formatted if INFO is filtered out
+        logger.info("Received message on %s: %s", msg.topic, msg.payload)
 
-        payload = msg.payload.decode()
-        logger.info(f"Received message on {msg.topic}: {payload}")
-        data = json.loads(payload)
-
-        if msg.topic == TOPIC_SUB_AUTH:
-            user_exists = data.get("exists", False)
-            balance = data.get("balance", 0)
-
-            if user_exists:
-                authenticated = True
-                logger.info(f"User authenticated. Balance: {balance} L")
-                start_dispensing(client)
-                authenticated = False
-            else:
-                logger.warning("Authentication failed. User does not exist.")
-
-        elif msg.topic == TOPIC_SUB_CONFIRM:
-            server_confirm = data.get("updated", False)
-            if server_confirm:
-                logger.info("Server confirmed balance update.")
-            else:
-                logger.warning("Server failed to confirm balance update.")
+        handler = TOPIC_HANDLERS.get(msg.topic)
+        if handler is None:
+            return
+        data = orjson.loads(msg.payload)  # Parses the raw bytes directly
+        handler(client, userdata, data)
 
     except Exception as e:
         logger.error(f"Error while processing incoming message: {e}")
@@ -96,106 +142,150 @@ def on_message(client, userdata, msg):
 # -------------------------------------------------------------------
 # Callback: When client disconnects from broker
 # -------------------------------------------------------------------
-def on_disconnect(client, userdata, rc, properties=None):
-    logger.warning("Disconnected from MQTT broker")
-    while True:
-        try:
-            logger.info("Attempting to reconnect...")
-            client.reconnect()
-            logger.info("Reconnected successfully")
-            break
-        except Exception as e:
-            logger.error(f"Reconnect failed: {e}")
-            time.sleep(5)
+def on_disconnect(client, userdata, disconnect_flags, reason_code, properties=None):
+    if reason_code == mqtt.MQTT_ERR_SUCCESS:
+        logger.info("Disconnected cleanly from MQTT broker")
+        return
+
+    # The loop_start() thread reconnects on its own with the backoff set in
+    # main(); blocking here would stall that thread.
+    logger.warning(f"Disconnected unexpectedly from MQTT broker, reason code {reason_code}")
+
+# -------------------------------------------------------------------
+# RFID: ask the reader to look for a card and raise IRQ on reply
+# -------------------------------------------------------------------
+def arm_card_irq():
+    with reader_lock:
+        reader.Write_MFRC522(reader.CommIEnReg, 0xA0)   # Active-low IRQ on RxIRq only
+        reader.Write_MFRC522(reader.CommIrqReg, 0x7F)   # Clear pending interrupts
+        reader.Write_MFRC522(reader.FIFOLevelReg, 0x80)  # Flush FIFO
+        reader.Write_MFRC522(reader.FIFODataReg, reader.PICC_REQIDL)
+        reader.Write_MFRC522(reader.CommandReg, reader.PCD_TRANSCEIVE)
+        reader.Write_MFRC522(reader.BitFramingReg, 0x87)  # StartSend, 7-bit REQA frame
+
+# -------------------------------------------------------------------
+# Callback: When the reader raises IRQ because a card answered
+# -------------------------------------------------------------------
+def on_card_irq(client, state):
+    # Runs in the RPi.GPIO callback thread: log errors instead of raising there
+    try:
+        with reader_lock:
+            status, uid_bytes = reader.MFRC522_Anticoll()
+        if status != reader.MI_OK:
+            return
+
+        # Same numbering as SimpleMFRC522.read(): 4 UID bytes plus the check byte
+        uid = int.from_bytes(bytes(uid_bytes[:5]), "big")
+        state.last_card_seen = time.monotonic()
+        if uid == state.current_card_uid:
+            return
+
+        state.current_card_uid = uid
+        message = f'{{"uid":"{uid}"}}'  # UID is an integer, nothing to escape
+        logger.info(f"Publishing UID: {uid} to topic: {TOPIC_PUB_UID}")
+        result = client.publish(TOPIC_PUB_UID, message, qos=0, retain=False)
+        if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            logger.info("UID published successfully")
+        elif result.rc == mqtt.MQTT_ERR_NO_CONN:
+            logger.error("MQTT disconnected — UID not sent")
+        else:
+            logger.warning(f"Failed to publish UID. Status: {result.rc}")
+    except Exception as e:
+        logger.error(f"Error while reading card: {e}")
 
 # -------------------------------------------------------------------
 # Start dispensing with real-time card validation
 # -------------------------------------------------------------------
-def start_dispensing(client):
-    global balance, current_card_uid
+def start_dispensing(client, state):
     logger.info("Starting water dispensing...")
 
-    initial_uid = current_card_uid
-    total_pulses = 0
-    start_time = time.time()
+    initial_uid = state.current_card_uid  # Plain int, compared by value each sample
     duration = 5  # seconds
+    sample_interval = 0.2
+    # Draw every flow sensor reading for the run in a single call
+    readings = random.choices(range(1, 6), k=int(duration / sample_interval))
+    deadline = time.monotonic() + duration  # Immune to wall-clock (NTP) jumps
 
-    while time.time() - start_time < duration:
-        try:
-            uid, _ = reader.read()
-            if uid != initial_uid:
-                logger.warning("Card changed. Stopping water dispensing.")
-                break
-        except Exception:
+    samples_taken = 0
+    while samples_taken < len(readings):
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        # current_card_uid and last_card_seen are kept up to date by on_card_irq().
+        # Check removal first: main() resets the UID to None once the card times out.
+        if state.current_card_uid is None or now - state.last_card_seen > CARD_TIMEOUT:
             logger.warning("Card removed. Stopping water dispensing.")
             break
+        if state.current_card_uid != initial_uid:
+            logger.warning("Card changed. Stopping water dispensing.")
+            break
 
-        pulses = random.randint(1, 5)
-        total_pulses += pulses
-        time.sleep(0.2)
+        samples_taken += 1
+        time.sleep(sample_interval)
+
+    # Add up the readings for the samples actually taken in one pass
+    total_pulses = sum(readings[:samples_taken])
 
     dispensed_ml = total_pulses * 2
     dispensed_liters = round(dispensed_ml / 1000, 2)
     logger.info(f"Water dispensed: {dispensed_liters} L")
 
-    balance -= dispensed_liters
-    balance = max(balance, 0)
+    state.balance = max(state.balance - dispensed_liters, 0)
 
-    result_msg = json.dumps({
-        "dispensed": dispensed_liters,
-        "updated_balance": round(balance, 2)
-    })
+    # Fixed schema of numbers only, so plain formatting matches json.dumps
+    result_msg = f'{{"dispensed":{dispensed_liters},"updated_balance":{round(state.balance, 2)}}}'
 
-    if client.is_connected():
-        client.publish(TOPIC_PUB_RESULT, result_msg, qos=0, retain=False)
+    result = client.publish(TOPIC_PUB_RESULT, result_msg, qos=0, retain=False)
+    if result.rc == mqtt.MQTT_ERR_SUCCESS:
         logger.info(f"Sent result to server: {result_msg}")
+    elif result.rc == mqtt.MQTT_ERR_NO_CONN:
+        logger.error("MQTT disconnected — result not sent")
     else:
-        logger.error("MQTT disconnected — skipping result publish")
+        logger.warning(f"Failed to publish result. Status: {result.rc}")
 
 # -------------------------------------------------------------------
 # Main Function
 # -------------------------------------------------------------------
 def main():
-    global current_card_uid
+    # Session state shared by the MQTT callbacks (as userdata) and the card IRQ
+    state = SimpleNamespace(authenticated=False, balance=0,
+                            current_card_uid=None, last_card_seen=0.0)
 
-    client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, clean_session=True)
+    client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2,
+                         protocol=mqtt.MQTTv5, userdata=state)
     client.max_queued_messages_set(0)
     client.on_connect = on_connect
     client.on_message = on_message
     client.on_disconnect = on_disconnect
+    client.reconnect_delay_set(min_delay=RECONNECT_MIN_DELAY, max_delay=RECONNECT_MAX_DELAY)
 
-    client.tls_set(tls_version=ssl.PROTOCOL_TLS_CLIENT)
+    client.tls_set_context(TLS_CONTEXT)
 
     try:
-        client.connect(BROKER, PORT, keepalive=10)
+        client.connect(BROKER, PORT, keepalive=10, clean_start=True)
     except Exception as e:
         logger.error(f"Could not connect to broker: {e}")
         return
 
     client.loop_start()
 
+    GPIO.setup(IRQ_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    GPIO.add_event_detect(IRQ_PIN, GPIO.FALLING,
+                          callback=lambda channel: on_card_irq(client, state),
+                          bouncetime=100)
+
     try:
+        # Reads happen in on_card_irq(); this loop only re-arms the reader
         while True:
-            try:
-                uid, _ = reader.read()
-                if uid != current_card_uid:
-                    current_card_uid = uid
-                    message = json.dumps({"uid": str(uid)})
-                    logger.info(f"Publishing UID: {uid} to topic: {TOPIC_PUB_UID}")
-                    if client.is_connected():
-                        result = client.publish(TOPIC_PUB_UID, message, qos=0, retain=False)
-                        if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                            logger.info("UID published successfully")
-                        else:
-                            logger.warning(f"Failed to publish UID. Status: {result.rc}")
-                    else:
-                        logger.error("MQTT disconnected — skipping publish")
-            except Exception:
-                current_card_uid = None  # Reset if card is not readable
-            time.sleep(1)
+            arm_card_irq()
+            time.sleep(REARM_INTERVAL)
+            if state.current_card_uid is not None and time.monotonic() - state.last_card_seen > CARD_TIMEOUT:
+                state.current_card_uid = None  # Reset once the card is gone
     except KeyboardInterrupt:
         logger.info("Disconnecting...")
     finally:
+        GPIO.remove_event_detect(IRQ_PIN)
+        GPIO.cleanup()
         client.loop_stop()
         client.disconnect()
 